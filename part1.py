@@ -19,17 +19,42 @@ Requirements:
 import argparse
 import asyncio
 import json
+import random
 import signal
 import socket
 import struct
-from cProfile import label
-from typing import cast, override
+from typing import BinaryIO, cast, override
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 type Address = tuple[str, int]
 
 HOST_ADDR = ("127.0.0.1", 1053)
 UPSTREAM_SERVER = "8.8.8.8"
 
+# Incoming datagrams are read into one reusable buffer of this size, draining
+# at most MAX_READS_PER_WAKEUP of them before yielding to the event loop
+MAX_DATAGRAM_SIZE = 65535
+MAX_READS_PER_WAKEUP = 64
+
+# Parsed replies are appended to LOG_FILE as one JSON object per line, each
+# flushed as a single write once complete
+LOG_FILE = "output.ndjson"
+LOG_BUFFER_SIZE = 1 << 16
+
+# Queries wait in a bounded queue for one of a fixed pool of workers
+QUERY_QUEUE_SIZE = 10000
+NUM_WORKERS = 64
+
+UNPACK_H = struct.Struct("!H").unpack_from
+UNPACK_4H = struct.Struct("!4H").unpack_from
+# Resource record fixed fields after the name: TYPE, skipping CLASS and TTL,
+# then RDLENGTH
+UNPACK_RR = struct.Struct("!H6xH").unpack_from
+
 DNS_TYPES = {
     1: "A",
     2: "NS",
@@ -51,74 +76,265 @@ DNS_TYPES = {
     255: "ANY",
 }
 
+# Indexed by type code; codes without a mnemonic fall back to the number
+DNS_TYPE_NAMES = tuple(DNS_TYPES.get(i, str(i)) for i in range(256))
 
-class BasicDNSProxy(asyncio.DatagramProtocol):
-    transport: asyncio.DatagramTransport | None
-    upstream_server: Address
-    debug: bool
 
-    def __init__(self, debug_flag: bool, upstream_server: str):
-        self.transport = None
-        self.upstream_server = (upstream_server, 53)
-        self.debug = debug_flag
+def expire(on_response: asyncio.Future[bytes]) -> None:
+    """
+    Timer callback that fails a still-pending upstream reply with a timeout.
+    """
+    if not on_response.done():
+        on_response.set_exception(asyncio.TimeoutError())
 
-    @override
-    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
-        self.transport = transport
-        print(f"Listening on {HOST_ADDR[0]}:{HOST_ADDR[1]}")
+
+def summarize_query(query: bytes, response: bytes) -> str:
+    """
+    Returns a one-line summary of a relayed query: the name and type of its
+    (first) question and the size of its reply. The question is read straight
+    off the wire, without the full parse of --debug.
+    """
+    try:
+        labels: list[str] = []
+        posn = 12
+        label_len = query[posn]
+        while label_len:
+            if label_len & 0xC0:
+                raise ValueError("Compressed QNAME in question")
+            labels.append(query[posn + 1 : posn + 1 + label_len].decode())
+            posn += 1 + label_len
+            label_len = query[posn]
+        record_type: int = UNPACK_H(query, posn + 1)[0]
+    except (IndexError, struct.error, ValueError):
+        return f"Malformed query, {len(response)}-byte reply"
+
+    if record_type < 256:
+        type_name = DNS_TYPE_NAMES[record_type]
+    else:
+        type_name = str(record_type)
+    return f"{'.'.join(labels) or '.'} {type_name}: {len(response)}-byte reply"
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    Receiving end of the upstream socket shared by all queries. Resolves the
+    pending future registered under the reply's transaction ID.
+    """
+
+    pending: dict[bytes, asyncio.Future[bytes]]
+
+    def __init__(self, pending: dict[bytes, asyncio.Future[bytes]]):
+        self.pending = pending
 
     @override
     def datagram_received(self, data: bytes, addr: Address) -> None:
-        _ = asyncio.create_task(self.handle_query(data, addr))
+        on_response = self.pending.get(data[:2])
+        if on_response and not on_response.done():
+            on_response.set_result(data)
+
+
+class BasicDNSProxy:
+    __slots__: tuple[str, ...] = (
+        "sock",
+        "recv_buf",
+        "recv_view",
+        "upstream",
+        "pending",
+        "query_queue",
+        "workers",
+        "log_queue",
+        "log_task",
+        "log_file",
+        "upstream_server",
+        "debug",
+        "inject_latency",
+    )
 
-    async def handle_query(self, data: bytes, addr: Address):
-        if self.debug:
-            print("Task sleeping...")
-            await asyncio.sleep(3)
+    sock: socket.socket | None
+    recv_buf: bytearray
+    recv_view: memoryview
+    upstream: asyncio.DatagramTransport | None
+    pending: dict[bytes, asyncio.Future[bytes]]
+    query_queue: asyncio.Queue[tuple[bytes, Address]]
+    workers: list[asyncio.Task[None]]
+    log_queue: asyncio.Queue[bytes]
+    log_task: asyncio.Task[None] | None
+    log_file: BinaryIO | None
 
-        transport: asyncio.DatagramTransport | None = None
+    upstream_server: Address
+    debug: bool
+    inject_latency: float
+
+    def __init__(
+        self, debug_flag: bool, upstream_server: str, inject_latency: float = 0.0
+    ):
+        self.sock = None
+        self.recv_buf = bytearray(MAX_DATAGRAM_SIZE)
+        self.recv_view = memoryview(self.recv_buf)
+        self.upstream = None
+        self.pending = {}
+        self.query_queue = asyncio.Queue(maxsize=QUERY_QUEUE_SIZE)
+        self.workers = []
+        self.log_queue = asyncio.Queue()
+        self.log_task = None
+        self.log_file = None
 
-        loop = asyncio.get_running_loop()
+        self.upstream_server = (upstream_server, 53)
+        self.debug = debug_flag
+        self.inject_latency = inject_latency
+
+    def connection_made(self, sock: socket.socket) -> None:
+        """
+        Starts serving on a bound, non-blocking UDP socket. The socket is
+        watched with loop.add_reader rather than wrapped in a datagram
+        transport, so that every datagram is received into the same buffer.
+        """
+        self.sock = sock
+        asyncio.get_running_loop().add_reader(sock.fileno(), self.read_ready)
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(NUM_WORKERS)]
+        if self.debug:
+            # Reply parsing is observability only; without --debug, nothing
+            # past forwarding is set up at all
+            self.log_task = asyncio.create_task(self.drain_log())
+            self.log_file = open(LOG_FILE, "ab", buffering=LOG_BUFFER_SIZE)
+        print(f"Listening on {HOST_ADDR[0]}:{HOST_ADDR[1]}")
 
-        for attempt in range(3):
+    def connection_lost(self) -> None:
+        """
+        Stops serving and releases the listening socket and the upstream
+        transport.
+        """
+        if self.sock:
+            _ = asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+        if self.upstream:
+            self.upstream.close()
+
+    async def close_log(self) -> None:
+        """
+        Stops drain_log, waiting out any reply it is still writing, and only
+        then closes the reply log.
+        """
+        if self.log_task:
+            _ = self.log_task.cancel()
+            _ = await asyncio.gather(self.log_task, return_exceptions=True)
+        if self.log_file:
+            self.log_file.close()
+
+    def read_ready(self) -> None:
+        sock = cast(socket.socket, self.sock)
+        for _ in range(MAX_READS_PER_WAKEUP):
             try:
-                on_response: asyncio.Future[bytes] = loop.create_future()
-
-                def on_response_factory():
-                    class Upstream(asyncio.DatagramProtocol):
-                        @override
-                        def datagram_received(self, data: bytes, addr: Address) -> None:
-                            if not on_response.done():
-                                on_response.set_result(data)
+                nbytes, addr = sock.recvfrom_into(self.recv_buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Receive failed: {e}")
+                return
 
-                    return Upstream()
+            self.datagram_received(self.recv_view[:nbytes].tobytes(), addr)
 
-                transport, _ = await loop.create_datagram_endpoint(
-                    on_response_factory,
-                    remote_addr=self.upstream_server,
-                    family=socket.AF_INET,
-                )
-
-                transport.sendto(data)
-
-                response = await asyncio.wait_for(on_response, timeout=3)
+    def datagram_received(self, data: bytes, addr: Address) -> None:
+        try:
+            self.query_queue.put_nowait((data, addr))
+        except asyncio.QueueFull:
+            print(f"Query queue full, dropped query from {addr}")
+
+    async def worker(self) -> None:
+        """
+        One of NUM_WORKERS long-lived consumers of the query queue, which
+        bound how many queries are in flight instead of a task per datagram.
+        """
+        while True:
+            data, addr = await self.query_queue.get()
+            try:
+                await self.handle_query(data, addr)
+            except Exception as e:
+                print(f"Query from {addr} failed: {e}")
 
-                parsed = self.DNSQueryParser(response)
-                print(parsed)
+    async def handle_query(self, data: bytes, addr: Address):
+        if self.inject_latency > 0:
+            print("Task sleeping...")
+            await asyncio.sleep(self.inject_latency)
 
-                transport_ = cast(asyncio.DatagramTransport, self.transport)
-                transport_.sendto(response, addr)
-                break
-            except asyncio.TimeoutError:
-                print(f"Upstream timeout for {addr}, attempt {attempt + 1}")
-                print(f"Retries remaining: {2 - attempt}")
-            finally:
-                if transport:
-                    transport.close()
+        loop = asyncio.get_running_loop()
+        upstream = cast(asyncio.DatagramTransport, self.upstream)
+
+        # Upstream replies are routed by transaction ID, so a query whose ID is
+        # already in flight goes out under a free one and is restored on reply
+        txid = data[:2]
+        while txid in self.pending:
+            txid = random.randbytes(2)
+        query = data if txid == data[:2] else txid + data[2:]
+
+        try:
+            for attempt in range(3):
+                try:
+                    on_response: asyncio.Future[bytes] = loop.create_future()
+                    self.pending[txid] = on_response
+
+                    upstream.sendto(query)
+
+                    timer = loop.call_later(3, expire, on_response)
+                    try:
+                        response = await on_response
+                    finally:
+                        timer.cancel()
+                    if query is not data:
+                        response = data[:2] + response[2:]
+
+                    try:
+                        _ = cast(socket.socket, self.sock).sendto(response, addr)
+                    except (BlockingIOError, InterruptedError):
+                        print(f"Send buffer full, dropped reply to {addr}")
+
+                    print(summarize_query(data, response))
+                    if self.debug:
+                        self.log_queue.put_nowait(response)
+                    break
+                except asyncio.TimeoutError:
+                    print(f"Upstream timeout for {addr}, attempt {attempt + 1}")
+                    print(f"Retries remaining: {2 - attempt}")
+        finally:
+            _ = self.pending.pop(txid, None)
+
+    async def drain_log(self) -> None:
+        """
+        Single consumer for replies queued by handle_query. Parsing and the
+        LOG_FILE dump run in the default executor, off the event loop;
+        draining in order keeps the file writes from interleaving.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            response = await self.log_queue.get()
+            write = loop.run_in_executor(None, self.log_reply, response)
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # The worker thread cannot be interrupted, so it is left to
+                # finish with LOG_FILE before the cancellation goes through
+                _ = await asyncio.wait([write])
+                raise
+            except Exception as e:
+                print(f"Failed to parse reply: {e}")
+
+    def log_reply(self, response: bytes) -> None:
+        parsed = self.DNSQueryParser(response)
+        log_file = cast(BinaryIO, self.log_file)
+        parsed.write_to_file(log_file)
+        log_file.flush()
+        print(parsed)
 
     class DNSQueryParser:
-        query_head: bytes
-        query_body: bytes
+        __slots__: tuple[str, ...] = (
+            "query",
+            "qd_records",
+            "an_records",
+            "ns_records",
+            "ar_records",
+        )
+
+        query: bytes
 
         qd_records: list[tuple[str, str]]
         an_records: list[tuple[str, str, int]]
@@ -126,8 +342,7 @@ class BasicDNSProxy(asyncio.DatagramProtocol):
         ar_records: list[tuple[str, str, int]]
 
         def __init__(self, query: bytes) -> None:
-            self.query_head = query[:12]
-            self.query_body = query[12:]
+            self.query = query
             qd, an, ns, ar = self.parse()
 
             self.qd_records = qd
@@ -135,8 +350,6 @@ class BasicDNSProxy(asyncio.DatagramProtocol):
             self.ns_records = ns
             self.ar_records = ar
 
-            self.write_to_file()
-
         @override
         def __str__(self) -> str:
             sections = [
@@ -176,111 +389,101 @@ class BasicDNSProxy(asyncio.DatagramProtocol):
             return "\n".join(lines)
 
         def parse(self):
-            counts: tuple[int, int, int, int] = struct.unpack(
-                "!4H", self.query_head[4:]
-            )
+            # Walks all four sections in one pass, binding hot lookups to
+            # locals once. Offsets, like compression pointers, are absolute
+            # in the packet; the question section starts after the header
+            body = self.query
+            parse_name = self.parse_name
+            counts: tuple[int, int, int, int] = UNPACK_4H(body, 4)
             QDCOUNT, ANCOUNT, NSCOUNT, ARCOUNT = counts
-            posn, qd = self.parse_questions(QDCOUNT, 0)
-            posn, an = self.parse_records(ANCOUNT, posn)
-            posn, ns = self.parse_records(NSCOUNT, posn)
-            posn, ar = self.parse_records(ARCOUNT, posn)
+            posn = 12
+
+            qd: list[tuple[str, str]] = []
+            add_question = qd.append
+            for _ in range(QDCOUNT):
+                posn, record_name = parse_name(posn)
+                record_type: int = UNPACK_H(body, posn)[0]
+                if record_type < 256:
+                    type_name = DNS_TYPE_NAMES[record_type]
+                else:
+                    type_name = str(record_type)
+                add_question((record_name, type_name))
+                posn += 4
+
+            an: list[tuple[str, str, int]] = []
+            ns: list[tuple[str, str, int]] = []
+            ar: list[tuple[str, str, int]] = []
+            for records, num_records in ((an, ANCOUNT), (ns, NSCOUNT), (ar, ARCOUNT)):
+                add_record = records.append
+                for _ in range(num_records):
+                    posn, record_name = parse_name(posn)
+                    fields: tuple[int, int] = UNPACK_RR(body, posn)
+                    record_type, rdlength = fields
+                    if record_type < 256:
+                        type_name = DNS_TYPE_NAMES[record_type]
+                    else:
+                        type_name = str(record_type)
+                    add_record((record_name, type_name, rdlength))
+                    posn += 10 + rdlength
 
             return (qd, an, ns, ar)
 
-        def parse_questions(
-            self, num_qns: int, posn: int
-        ) -> tuple[int, list[tuple[str, str]]]:
-            questions: list[tuple[str, str]] = []
-            for _ in range(num_qns):
-                posn, record_name = self.parse_name(posn)
-                posn, record_type = self.parse_type(posn)
-                questions.append((record_name, record_type))
-                posn += 2
-
-            return posn, questions
-
-        def parse_records(self, num_records: int, posn: int):
-            records: list[tuple[str, str, int]] = []
-            for _ in range(num_records):
-                posn, record_name = self.parse_name(posn)
-                posn, record_type = self.parse_type(posn)
-                posn += 6
-                rdlength = struct.unpack("!H", self.query_body[posn : posn + 2])[0]
-                assert isinstance(rdlength, int)
-                records.append((record_name, record_type, rdlength))
-                posn += 2 + rdlength
-
-            return posn, records
-
         def parse_name(self, posn: int) -> tuple[int, str]:
+            body = self.query
             name: list[str] = []
-            label_len = self.query_body[posn]
+            end: int | None = None
+            label_len = body[posn]
 
             while label_len != 0:
-                if not self.is_pointer(label_len):
-                    label_val = struct.unpack(
-                        f"{label_len}s",
-                        self.query_body[1 + posn : 1 + posn + label_len],
-                    )[0]
-                    assert isinstance(label_val, bytes)
-                    name.append(label_val.decode())
+                # The top two bits are either both set (pointer) or both
+                # clear (label of up to 63 bytes)
+                if not label_len & 0xC0:
+                    name.append(body[1 + posn : 1 + posn + label_len].decode())
                     posn += 1 + label_len
-                    label_len = self.query_body[posn]
                 else:
-                    ptr_offset = (
-                        struct.unpack("!H", self.query_body[posn : posn + 2])[0]
-                        & 0x3FFF
-                    ) - 12
-                    assert isinstance(ptr_offset, int)
-                    _, ref = self.parse_name(ptr_offset)
-                    name.append(ref)
-                    break
-
-            if label_len == 0:
-                return (posn + 1, ".".join(name))
-            else:
-                return (posn + 2, ".".join(name))
-
-        def parse_type(self, posn: int) -> tuple[int, str]:
-            record_type = struct.unpack("!H", self.query_body[posn : posn + 2])[0]
-            assert isinstance(record_type, int)
-            posn += 2
-            return (posn, DNS_TYPES[record_type])
-
-        def is_pointer(self, bytes: int) -> bool:
-            return True if (bytes >> 6) & 0b11 == 0b11 else False
-
-        def write_to_file(self) -> None:
-            with open("output.json", "w") as output:
-                data = {
-                    "question": [
-                        {"name": name, "type": type} for name, type in self.qd_records
-                    ],
-                    "answer": [
-                        {"name": name, "type": type, "resource_size": size}
-                        for name, type, size in self.an_records
-                    ],
-                    "authority": [
-                        {"name": name, "type": type, "resource_size": size}
-                        for name, type, size in self.ns_records
-                    ],
-                    "additional": [
-                        {"name": name, "type": type, "resource_size": size}
-                        for name, type, size in self.ar_records
-                    ],
-                }
-
-                json.dump(
-                    data,
-                    output,
-                    indent=4,
-                )
+                    # Follow the pointer in place; the name ends after the
+                    # first pointer. Only backward jumps are valid, which also
+                    # rules out pointer loops
+                    ptr_offset = (label_len & 0x3F) << 8 | body[posn + 1]
+                    if not 12 <= ptr_offset < posn:
+                        raise ValueError(f"Bad compression pointer at {posn}")
+                    if end is None:
+                        end = posn + 2
+                    posn = ptr_offset
+                label_len = body[posn]
+
+            return (posn + 1 if end is None else end, ".".join(name))
+
+        def write_to_file(self, output: BinaryIO) -> None:
+            data = {
+                "question": [
+                    {"name": name, "type": type} for name, type in self.qd_records
+                ],
+                "answer": [
+                    {"name": name, "type": type, "resource_size": size}
+                    for name, type, size in self.an_records
+                ],
+                "authority": [
+                    {"name": name, "type": type, "resource_size": size}
+                    for name, type, size in self.ns_records
+                ],
+                "additional": [
+                    {"name": name, "type": type, "resource_size": size}
+                    for name, type, size in self.ar_records
+                ],
+            }
+
+            _ = output.write(json.dumps(data, separators=(",", ":")).encode())
+            _ = output.write(b"\n")
 
 
 async def main():
     parser = argparse.ArgumentParser()
     _ = parser.add_argument("--upstream", type=str, default=UPSTREAM_SERVER)
     _ = parser.add_argument("--debug", action="store_true")
+    _ = parser.add_argument(
+        "--inject-latency", type=float, default=0.0, metavar="SECONDS"
+    )
     args = parser.parse_args()
 
     loop = asyncio.get_running_loop()
@@ -288,14 +491,25 @@ async def main():
 
     loop.add_signal_handler(signal.SIGINT, stop_event.set)
 
-    transport, _ = await loop.create_datagram_endpoint(
-        lambda: BasicDNSProxy(args.debug, args.upstream), local_addr=HOST_ADDR
+    proxy = BasicDNSProxy(args.debug, args.upstream, args.inject_latency)
+
+    upstream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    upstream_sock.setblocking(False)
+    upstream_sock.connect(proxy.upstream_server)
+    proxy.upstream, _ = await loop.create_datagram_endpoint(
+        lambda: UpstreamProtocol(proxy.pending), sock=upstream_sock
     )
 
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind(HOST_ADDR)
+    proxy.connection_made(sock)
+
     try:
         _ = await stop_event.wait()
     finally:
-        transport.close()
+        proxy.connection_lost()
+        await proxy.close_log()
 
     pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
     for task in pending:
@@ -305,4 +519,7 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
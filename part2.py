@@ -17,21 +17,58 @@ Requirements:
 
 import argparse
 import asyncio
-import json
+import random
 import signal
 import socket
+import struct
+import time
+from collections import OrderedDict
 from typing import cast, override
+from urllib.parse import quote
 
+import dns.exception
 import dns.message
+import orjson
 import requests
 from dns.rrset import RRset
+from requests.adapters import HTTPAdapter
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 type Address = tuple[str, int]
+type CacheKey = tuple[bytes, int]
 
 HOST_ADDR = ("127.0.0.1", 1053)
 UPSTREAM_SERVER = "8.8.8.8"
 UPSTREAM_SERVER_DOH = "https://dns.google/resolve?"
 
+# Most replies kept in the cache; the least recently used go first
+CACHE_SIZE = 4096
+# Upper bound on JSON API requests in flight, and pooled connections kept open
+DOH_CONCURRENCY = 32
+
+# Every datagram is received into one preallocated buffer of this size, and at
+# most this many are read off the socket each time it becomes readable
+MAX_DATAGRAM_SIZE = 65535
+MAX_READS_PER_WAKEUP = 64
+
+# Header fields through QDCOUNT, and a question's trailing QTYPE/QCLASS (or
+# a header's QDCOUNT/ANCOUNT)
+UNPACK_3H = struct.Struct("!3H").unpack_from
+UNPACK_2H = struct.Struct("!2H").unpack_from
+# TTL and RDLENGTH of a resource record, skipping TYPE and CLASS
+UNPACK_RR = struct.Struct("!4xIH").unpack_from
+# All four section counts of a header, and the TYPE, TTL and RDLENGTH of a
+# resource record along with a packer for rewriting just its TTL
+UNPACK_4H = struct.Struct("!4H").unpack_from
+UNPACK_RR_TYPE = struct.Struct("!H2xIH").unpack_from
+PACK_TTL = struct.Struct("!I").pack_into
+# Pseudo-record type whose TTL field holds EDNS flags rather than a TTL
+OPT_TYPE = 41
+
 DNS_TYPES = {
     1: "A",
     2: "NS",
@@ -53,161 +90,416 @@ DNS_TYPES = {
     255: "ANY",
 }
 
+# Indexed by type code; codes without a mnemonic fall back to the number
+DNS_TYPE_NAMES = tuple(DNS_TYPES.get(i, str(i)) for i in range(256))
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    Receiving end of the upstream socket shared by all queries. Resolves the
+    pending future registered under the reply's transaction ID.
+    """
+
+    pending: dict[bytes, asyncio.Future[bytes]]
+
+    def __init__(self, pending: dict[bytes, asyncio.Future[bytes]]):
+        self.pending = pending
+
+    @override
+    def datagram_received(self, data: bytes, addr: Address) -> None:
+        on_response = self.pending.get(data[:2])
+        if on_response and not on_response.done():
+            on_response.set_result(data)
+
+
+class BasicDNSProxy:
+    sock: socket.socket | None
+    recv_buf: bytearray
+    recv_view: memoryview
+    upstream: asyncio.DatagramTransport | None
+    pending: dict[bytes, asyncio.Future[bytes]]
+    session: requests.Session | None
+    doh_slots: asyncio.Semaphore
+    doh_url: str
+    cache: OrderedDict[CacheKey, tuple[float, float, bytes]]
+    inflight: dict[CacheKey, asyncio.Future[bytes | None]]
+    log_queue: asyncio.Queue[bytes]
+    log_task: asyncio.Task[None] | None
 
-class BasicDNSProxy(asyncio.DatagramProtocol):
-    transport: asyncio.DatagramTransport | None
     upstream_server: Address
     debug: bool
     doh: bool
-
-    def __init__(self, debug_flag: bool, upstream_server: str, doh_flag: bool):
-        self.transport = None
+    inject_latency: float
+
+    def __init__(
+        self,
+        debug_flag: bool,
+        upstream_server: str,
+        doh_flag: bool,
+        inject_latency: float = 0.0,
+    ):
+        self.sock = None
+        self.recv_buf = bytearray(MAX_DATAGRAM_SIZE)
+        self.recv_view = memoryview(self.recv_buf)
+        self.upstream = None
+        self.pending = {}
         self.upstream_server = (upstream_server, 80 if doh_flag else 53)
 
         self.debug = debug_flag
         self.doh = doh_flag
-
-    @override
-    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
-        self.transport = transport
+        self.inject_latency = inject_latency
+
+        # One pooled session for all DoH queries, so connections to the
+        # upstream are kept alive and reused
+        self.session = requests.Session() if self.doh else None
+        if self.session:
+            adapter = HTTPAdapter(pool_maxsize=DOH_CONCURRENCY)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+        self.doh_slots = asyncio.Semaphore(DOH_CONCURRENCY)
+
+        # JSON API requests differ only in name and type, so the rest of the
+        # query string is encoded once here instead of from a params dict
+        url = self.upstream_server[0]
+        sep = "" if url.endswith(("?", "&")) else "&" if "?" in url else "?"
+        self.doh_url = f"{url}{sep}ct=application%2Fdns-message"
+
+        # Wire-format replies by question, with the times they were stored and
+        # expire at
+        self.cache = OrderedDict()
+        # Replies still being fetched upstream, by question
+        self.inflight = {}
+        # Replies waiting to be parsed and dumped under --debug
+        self.log_queue = asyncio.Queue()
+        self.log_task = None
+
+    def connection_made(self, sock: socket.socket) -> None:
+        """
+        Starts serving on a bound, non-blocking UDP socket. The socket is
+        watched with loop.add_reader rather than wrapped in a datagram
+        transport, so that one wakeup reads up to MAX_READS_PER_WAKEUP datagrams.
+        """
+        self.sock = sock
+        asyncio.get_running_loop().add_reader(sock.fileno(), self.read_ready)
+        if self.debug:
+            self.log_task = asyncio.create_task(self.drain_log())
         print(f"Listening on {HOST_ADDR[0]}:{HOST_ADDR[1]}")
 
-    @override
+    def connection_lost(self) -> None:
+        """
+        Stops serving and releases the listening socket, the upstream
+        transport and the DoH session.
+        """
+        if self.sock:
+            _ = asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+        if self.upstream:
+            self.upstream.close()
+        if self.session:
+            self.session.close()
+
+    def read_ready(self) -> None:
+        sock = cast(socket.socket, self.sock)
+        for _ in range(MAX_READS_PER_WAKEUP):
+            try:
+                nbytes, addr = sock.recvfrom_into(self.recv_buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Receive failed: {e}")
+                return
+
+            self.datagram_received(self.recv_view[:nbytes].tobytes(), addr)
+
+    def send_reply(self, reply: bytes, addr: Address) -> None:
+        try:
+            _ = cast(socket.socket, self.sock).sendto(reply, addr)
+        except (BlockingIOError, InterruptedError):
+            print(f"Send buffer full, dropped reply to {addr}")
+
     def datagram_received(self, data: bytes, addr: Address) -> None:
+        # Only the question is needed to look up the cache
+        key: CacheKey | None = None
+        try:
+            _, _, qname, qtype = peek_query(data)
+            key = (qname, qtype)
+        except ValueError:
+            pass
+
+        if key:
+            reply = self.cache_lookup(key)
+            if reply:
+                self.send_reply(reply_for(data, reply), addr)
+                return
+
+        # Plain UDP queries are forwarded as-is, so only DoH needs the full
+        # Message; it is parsed once here and passed down to the handler
+        msg: dns.message.Message | None = None
         if self.doh:
-            _ = asyncio.create_task(self.handle_doh_query(data, addr))
-        else:
-            _ = asyncio.create_task(self.handle_query(data, addr))
-
-    async def handle_doh_query(self, data: bytes, addr: Address) -> None:
-        if self.debug:
+            try:
+                msg = dns.message.from_wire(data)
+            except dns.exception.DNSException:
+                print(f"Malformed query from {addr}")
+                return
+
+        _ = asyncio.create_task(self.dispatch_query(data, msg, addr, key))
+
+    async def dispatch_query(
+        self,
+        data: bytes,
+        msg: dns.message.Message | None,
+        addr: Address,
+        key: CacheKey | None,
+    ) -> None:
+        """
+        Hands a query to its upstream handler, unless the same question is
+        already being fetched; then it waits for that reply and relays it
+        under its own transaction ID and question instead.
+        """
+        if not key:
+            if self.doh:
+                init_msg = cast(dns.message.Message, msg)
+                _ = await self.handle_doh_query(data, init_msg, addr, key)
+            else:
+                _ = await self.handle_query(data, addr, key)
+            return
+
+        inflight = self.inflight.get(key)
+        if inflight:
+            # Shielded so that cancelling this task leaves the fetch alone
+            reply = await asyncio.shield(inflight)
+            if reply:
+                self.send_reply(reply_for(data, reply), addr)
+            return
+
+        inflight = self.inflight[key] = asyncio.get_running_loop().create_future()
+        reply: bytes | None = None
+        try:
+            if self.doh:
+                init_msg = cast(dns.message.Message, msg)
+                reply = await self.handle_doh_query(data, init_msg, addr, key)
+            else:
+                reply = await self.handle_query(data, addr, key)
+        finally:
+            del self.inflight[key]
+            inflight.set_result(reply)
+
+    def cache_lookup(self, key: CacheKey) -> bytes | None:
+        """
+        Returns the cached reply to a question, unless it is missing or has
+        outlived its TTL. Its TTLs are counted down by the time it has spent
+        in the cache, as a resolver's would be.
+        """
+        entry = self.cache.get(key)
+        if not entry:
+            return None
+
+        stored, expiry, reply = entry
+        now = time.monotonic()
+        if expiry <= now:
+            del self.cache[key]
+            return None
+
+        try:
+            reply = age_reply(reply, int(now - stored))
+        except ValueError:
+            del self.cache[key]
+            return None
+
+        self.cache.move_to_end(key)
+        return reply
+
+    def cache_store(self, key: CacheKey | None, reply: bytes) -> None:
+        """
+        Caches a reply for as long as the shortest TTL among its answers,
+        evicting the least recently used entry once CACHE_SIZE is exceeded.
+        """
+        if not key:
+            return
+        try:
+            ttl = min_answer_ttl(reply)
+        except ValueError:
+            return
+        if ttl <= 0:
+            return
+
+        now = time.monotonic()
+        self.cache[key] = (now, now + ttl, reply)
+        self.cache.move_to_end(key)
+        if len(self.cache) > CACHE_SIZE:
+            _ = self.cache.popitem(last=False)
+
+    async def handle_doh_query(
+        self,
+        data: bytes,
+        init_msg: dns.message.Message,
+        addr: Address,
+        key: CacheKey | None,
+    ) -> bytes | None:
+        if self.inject_latency > 0:
             print("Task sleeping...")
-            await asyncio.sleep(3)
+            await asyncio.sleep(self.inject_latency)
 
-        params_lst = self.make_query_params(data)
+        urls = self.make_query_urls(init_msg)
 
         for attempt in range(3):
             try:
-                tasks = [
-                    asyncio.to_thread(
-                        requests.get, self.upstream_server[0], params, timeout=3
-                    )
-                    for params in params_lst
-                ]
-
-                responses = await asyncio.gather(*tasks)
-
-                transport_ = cast(asyncio.DatagramTransport, self.transport)
-
-                for r in responses:
-                    parsed = self.DNSQueryParser(r.content)
-                    print(parsed)
-
-                    reply_msg = parsed.build_dns_reply(data)
-                    transport_.sendto(reply_msg.to_wire(), addr)
-
-                break
-            except asyncio.TimeoutError or requests.exceptions.Timeout:
+                # Should one request fail, the group cancels the rest rather
+                # than leaving them to run out their timeouts
+                async with asyncio.TaskGroup() as group:
+                    fetches = [group.create_task(self.fetch_json(u)) for u in urls]
+
+                reply: bytes | None = None
+                for fetch in fetches:
+                    # The upstream sends back a complete reply in wire format
+                    # (ct=application/dns-message) to a query of its own
+                    # making, so it is readdressed to the client's
+                    reply = reply_for(data, fetch.result())
+                    self.send_reply(reply, addr)
+                    self.cache_store(key, reply)
+
+                    if self.debug:
+                        self.log_queue.put_nowait(reply)
+
+                return reply
+            except* (asyncio.TimeoutError, requests.exceptions.Timeout):
                 print(f"Upstream timeout for {addr}, attempt {attempt + 1}")
                 print(f"Retries remaining: {2 - attempt}")
-            except requests.exceptions.ConnectionError:
+            except* requests.exceptions.ConnectionError:
                 print(f"Upstream refused connection for {addr}, attempt {attempt + 1}")
                 print(f"Retries remaining: {2 - attempt}")
                 if attempt < 2:
                     await asyncio.sleep(1)
+            except* requests.exceptions.HTTPError as e:
+                error = e.exceptions[0]
+                print(f"Upstream error for {addr}, attempt {attempt + 1}: {error}")
+                print(f"Retries remaining: {2 - attempt}")
+                if attempt < 2:
+                    await asyncio.sleep(1)
 
-    def make_query_params(self, data: bytes):
-        params_lst: list[dict[str, str]] = []
-        questions = dns.message.from_wire(data).question
-        for q in questions:
-            name = q.name.to_unicode()
-            type = DNS_TYPES[q.rdtype]
-            params_lst.append(
-                {"name": name, "type": type, "ct": "application/dns-message"}
-            )
-
-        return params_lst
-
-    async def handle_query(self, data: bytes, addr: Address) -> None:
-        if self.debug:
+        return None
+
+    async def fetch_json(self, url: str) -> bytes:
+        """
+        Sends one JSON API request on a worker thread and returns the DNS reply
+        it carries. At most DOH_CONCURRENCY run at once, so the session's
+        connection pool is never outgrown.
+        """
+        session_ = cast(requests.Session, self.session)
+        async with self.doh_slots:
+            response = await asyncio.to_thread(session_.get, url, timeout=3)
+        return dns_message_body(response)
+
+    def make_query_urls(self, msg: dns.message.Message) -> list[str]:
+        urls: list[str] = []
+        for q in msg.question:
+            name = quote(q.name.to_unicode())
+            type = DNS_TYPE_NAMES[q.rdtype] if q.rdtype < 256 else str(q.rdtype)
+            urls.append(f"{self.doh_url}&name={name}&type={type}")
+
+        return urls
+
+    async def handle_query(
+        self, data: bytes, addr: Address, key: CacheKey | None
+    ) -> bytes | None:
+        if self.inject_latency > 0:
             print("Task sleeping...")
-            await asyncio.sleep(3)
-
-        transport: asyncio.DatagramTransport | None = None
+            await asyncio.sleep(self.inject_latency)
 
         loop = asyncio.get_running_loop()
+        upstream = cast(asyncio.DatagramTransport, self.upstream)
+
+        # Upstream replies are routed by transaction ID, so a query whose ID is
+        # already in flight goes out under a free one and is restored on reply
+        txid = data[:2]
+        while txid in self.pending:
+            txid = random.randbytes(2)
+        query = data if txid == data[:2] else txid + data[2:]
 
         for attempt in range(3):
             try:
                 on_response: asyncio.Future[bytes] = loop.create_future()
+                self.pending[txid] = on_response
 
-                def on_response_factory():
-                    class Upstream(asyncio.DatagramProtocol):
-                        @override
-                        def datagram_received(self, data: bytes, addr: Address) -> None:
-                            if not on_response.done():
-                                on_response.set_result(data)
-
-                    return Upstream()
-
-                transport, _ = await loop.create_datagram_endpoint(
-                    on_response_factory,
-                    remote_addr=self.upstream_server,
-                    family=socket.AF_INET,
-                )
-
-                transport.sendto(data)
+                upstream.sendto(query)
 
                 response: bytes = await asyncio.wait_for(on_response, timeout=3)
+                if query is not data:
+                    response = data[:2] + response[2:]
 
-                parsed = self.DNSQueryParser(response)
-                print(parsed)
+                self.send_reply(response, addr)
+                self.cache_store(key, response)
 
-                transport_ = cast(asyncio.DatagramTransport, self.transport)
-                transport_.sendto(response, addr)
-                break
+                if self.debug:
+                    self.log_queue.put_nowait(response)
+                return response
             except asyncio.TimeoutError:
                 print(f"Upstream timeout for {addr}, attempt {attempt + 1}")
                 print(f"Retries remaining: {2 - attempt}")
             finally:
-                if transport:
-                    transport.close()
+                _ = self.pending.pop(txid, None)
+
+        return None
+
+    async def drain_log(self) -> None:
+        """
+        Single consumer for replies queued under --debug. Parsing and the
+        output.json dump run on a worker thread, off the event loop; draining
+        in order keeps one dump from truncating the file under another.
+        """
+        while True:
+            reply = await self.log_queue.get()
+            try:
+                await asyncio.to_thread(self.log_reply, reply)
+            except Exception as e:
+                print(f"Failed to parse reply: {e}")
+
+    def log_reply(self, reply: bytes) -> None:
+        parsed = self.DNSQueryParser(reply)
+        print(parsed)
+        parsed.write_to_file()
 
     class DNSQueryParser:
         query: dns.message.Message
+        records: dict[str, list[tuple[str, str, int | None]]]
 
         def __init__(self, query: bytes) -> None:
             self.query = dns.message.from_wire(query)
 
-            self.write_to_file()
+            # Each section is walked once; __str__ and write_to_file share it
+            self.records = {
+                "question": self.parse_section(self.query.question),
+                "answer": self.parse_section(self.query.answer),
+                "authority": self.parse_section(self.query.authority),
+                "additional": self.parse_section(
+                    self.query.additional + [self.query.opt]
+                    if self.query.opt
+                    else self.query.additional
+                ),
+            }
 
         @override
         def __str__(self) -> str:
             sections = [
-                ("Questions", self.query.question),
-                ("Answer RRs", self.query.answer),
-                ("Authority RRs", self.query.authority),
-                ("Additional RRs", self.query.additional),
+                ("Questions", self.records["question"]),
+                ("Answer RRs", self.records["answer"]),
+                ("Authority RRs", self.records["authority"]),
+                ("Additional RRs", self.records["additional"]),
             ]
 
             lines = ["\n=START==============="]
 
-            for section, rrsets in sections:
-                section_count = self.query.section_count(rrsets)
-                lines.append(f"{section} ({section_count}):")
+            for section, records in sections:
+                lines.append(f"{section} ({len(records)}):")
 
-                if not section_count:
+                if not records:
                     lines.append("  (none)")
-                else:
-                    records = self.parse_section(rrsets)
-                    if not records and self.query.opt:
-                        records = self.parse_section([self.query.opt])
 
-                    for name, type, rlength in records:
-                        line = f"  - Name: {name}, Type: {type}"
-                        if rlength:
-                            line += f" ({rlength} bytes)"
-                        lines.append(line)
+                for name, type, rlength in records:
+                    line = f"  - Name: {name}, Type: {type}"
+                    if rlength:
+                        line += f" ({rlength} bytes)"
+                    lines.append(line)
 
             lines.append("==============END=\n")
             return "\n".join(lines)
@@ -215,65 +507,184 @@ class BasicDNSProxy(asyncio.DatagramProtocol):
         def parse_section(
             self, rrsets: list[RRset]
         ) -> list[tuple[str, str, int | None]]:
+            # processing_order() builds a fresh shuffled list, so it is only called
+            # once per RRset; hot lookups are bound to locals up front
             records: list[tuple[str, str, int | None]] = []
+            add_record = records.append
+            type_names = DNS_TYPE_NAMES
             for rrset in rrsets:
                 name = rrset.name.to_unicode()
-                type = DNS_TYPES[rrset.rdtype]
+                rdtype = rrset.rdtype
+                type = type_names[rdtype] if rdtype < 256 else str(rdtype)
 
-                if not rrset.processing_order():
-                    records.append((name, type, None))
+                order = rrset.processing_order()
+                if not order:
+                    add_record((name, type, None))
                 else:
-                    for rdata in rrset.processing_order():
+                    for rdata in order:
                         bytes = rdata.to_wire()
                         rlength = len(bytes) if bytes else 0
-                        records.append((name, type, rlength))
+                        add_record((name, type, rlength))
 
             return records
 
-        def build_dns_reply(self, init_data: bytes) -> dns.message.Message:
-            init_message = dns.message.from_wire(init_data)
-
-            reply_msg = dns.message.make_response(
-                init_message,
-                recursion_available=True,
-            )
-            reply_msg.answer.extend(self.query.answer)
-            reply_msg.authority.extend(self.query.authority)
-            reply_msg.additional.extend(self.query.additional)
-            reply_msg.use_edns(
-                edns=self.query.edns,
-                ednsflags=self.query.ednsflags,
-                payload=self.query.payload,
-            )
-
-            return reply_msg
-
         def write_to_file(self) -> None:
-            with open("output.json", "w") as output:
+            with open("output.json", "wb") as output:
                 data = {
                     "question": [
                         {"name": name, "type": type}
-                        for name, type, _ in self.parse_section(self.query.question)
+                        for name, type, _ in self.records["question"]
                     ],
                     "answer": [
                         {"name": name, "type": type, "resource_size": size}
-                        for name, type, size in self.parse_section(self.query.answer)
+                        for name, type, size in self.records["answer"]
                     ],
                     "authority": [
                         {"name": name, "type": type, "resource_size": size}
-                        for name, type, size in self.parse_section(self.query.authority)
+                        for name, type, size in self.records["authority"]
                     ],
                     "additional": [
                         {"name": name, "type": type, "resource_size": size}
-                        for name, type, size in self.parse_section(
-                            self.query.additional + [self.query.opt]
-                            if self.query.opt
-                            else self.query.additional
-                        )
+                        for name, type, size in self.records["additional"]
                     ],
                 }
 
-                json.dump(data, output, indent=4)
+                _ = output.write(orjson.dumps(data))
+
+
+def peek_query(data: bytes) -> tuple[int, int, bytes, int]:
+    """
+    Reads a query's ID, flags, QNAME and QTYPE straight off the wire, without
+    building a Message. QNAME is returned in wire format, lowercased, so it can
+    be compared directly. Raises ValueError unless the query is well-formed and
+    has exactly one question.
+    """
+    try:
+        header: tuple[int, int, int] = UNPACK_3H(data, 0)
+        id, flags, qdcount = header
+        if qdcount != 1:
+            raise ValueError(f"Expected one question, got {qdcount}")
+
+        posn = 12
+        label_len = data[posn]
+        while label_len:
+            if label_len & 0xC0:
+                raise ValueError("Compressed QNAME in question")
+            posn += label_len + 1
+            label_len = data[posn]
+
+        question: tuple[int, int] = UNPACK_2H(data, posn + 1)
+    except (IndexError, struct.error) as e:
+        raise ValueError("Truncated query") from e
+
+    return id, flags, data[12 : posn + 1].lower(), question[0]
+
+
+def dns_message_body(response: requests.Response) -> bytes:
+    """
+    Returns the DNS reply carried in the body of a DoH response. Raises
+    requests.exceptions.HTTPError if the upstream answered with an error
+    status, or with anything other than a DNS message.
+    """
+    response.raise_for_status()
+    content_type = response.headers.get("content-type")
+    if content_type != "application/dns-message":
+        raise requests.exceptions.HTTPError(
+            f"Unexpected content type {content_type!r}", response=response
+        )
+    return response.content
+
+
+def skip_name(data: bytes, posn: int) -> int:
+    """
+    Returns the offset just past the (possibly compressed) name at posn.
+    """
+    label_len = data[posn]
+    while label_len:
+        if label_len & 0xC0:
+            return posn + 2
+        posn += label_len + 1
+        label_len = data[posn]
+    return posn + 1
+
+
+def reply_for(query: bytes, reply: bytes) -> bytes:
+    """
+    Readdresses a reply fetched for the same question to another query, with
+    the query's own transaction ID, RD and CD flags and question section.
+    Questions match case-insensitively, so the one asked may be capitalized
+    differently. Falls back to patching only the header if the two questions
+    are not laid out alike.
+    """
+    # RD is the low bit of the header's third byte and CD the 0x10 bit of its
+    # fourth; both are set by the client and echoed back in the reply
+    flags = bytes(
+        (reply[2] & ~0x01 | query[2] & 0x01, reply[3] & ~0x10 | query[3] & 0x10)
+    )
+    header = query[:2] + flags + reply[4:12]
+    try:
+        qend = skip_name(query, 12) + 4
+        if query[4:6] == reply[4:6] == b"\x00\x01" and skip_name(reply, 12) + 4 == qend:
+            return header + query[12:qend] + reply[qend:]
+    except IndexError:
+        pass
+
+    return header + reply[12:]
+
+
+def min_answer_ttl(data: bytes) -> int:
+    """
+    Returns the shortest TTL among a reply's answer records, read straight off
+    the wire, or 0 if it has none. Raises ValueError if the reply is truncated.
+    """
+    try:
+        counts: tuple[int, int] = UNPACK_2H(data, 4)
+        qdcount, ancount = counts
+
+        posn = 12
+        for _ in range(qdcount):
+            posn = skip_name(data, posn) + 4
+
+        ttl: int | None = None
+        for _ in range(ancount):
+            posn = skip_name(data, posn)
+            fields: tuple[int, int] = UNPACK_RR(data, posn)
+            record_ttl, rdlength = fields
+            if ttl is None or record_ttl < ttl:
+                ttl = record_ttl
+            posn += 10 + rdlength
+    except (IndexError, struct.error) as e:
+        raise ValueError("Truncated reply") from e
+
+    return ttl or 0
+
+
+def age_reply(data: bytes, elapsed: int) -> bytes:
+    """
+    Returns a copy of a reply with the TTL of every record lowered by elapsed
+    seconds, but not below 0. The OPT pseudo-record is left as it is. Raises
+    ValueError if the reply is truncated.
+    """
+    aged = bytearray(data)
+    try:
+        counts: tuple[int, int, int, int] = UNPACK_4H(data, 4)
+        qdcount, ancount, nscount, arcount = counts
+
+        posn = 12
+        for _ in range(qdcount):
+            posn = skip_name(data, posn) + 4
+
+        for _ in range(ancount + nscount + arcount):
+            posn = skip_name(data, posn)
+            fields: tuple[int, int, int] = UNPACK_RR_TYPE(data, posn)
+            rdtype, ttl, rdlength = fields
+            if rdtype != OPT_TYPE:
+                PACK_TTL(aged, posn + 4, max(ttl - elapsed, 0))
+            posn += 10 + rdlength
+    except (IndexError, struct.error) as e:
+        raise ValueError("Truncated reply") from e
+
+    return bytes(aged)
 
 
 async def main():
@@ -281,6 +692,9 @@ async def main():
     _ = parser.add_argument("--upstream", type=str, default=UPSTREAM_SERVER)
     _ = parser.add_argument("--debug", action="store_true")
     _ = parser.add_argument("--doh", action="store_true")
+    _ = parser.add_argument(
+        "--inject-latency", type=float, default=0.0, metavar="SECONDS"
+    )
     args = parser.parse_args()
 
     loop = asyncio.get_running_loop()
@@ -294,16 +708,25 @@ async def main():
         else args.upstream
     )
 
-    proxy = BasicDNSProxy(args.debug, upstream, args.doh)
-    transport, _ = await loop.create_datagram_endpoint(
-        lambda: proxy,
-        local_addr=HOST_ADDR,
-    )
+    proxy = BasicDNSProxy(args.debug, upstream, args.doh, args.inject_latency)
+
+    if not args.doh:
+        upstream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        upstream_sock.setblocking(False)
+        upstream_sock.connect(proxy.upstream_server)
+        proxy.upstream, _ = await loop.create_datagram_endpoint(
+            lambda: UpstreamProtocol(proxy.pending), sock=upstream_sock
+        )
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind(HOST_ADDR)
+    proxy.connection_made(sock)
 
     try:
         _ = await stop_event.wait()
     finally:
-        transport.close()
+        proxy.connection_lost()
 
     pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
     for task in pending:
@@ -313,4 +736,7 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
@@ -11,260 +11,598 @@ Requirements:
 - Log end-to-end latency for each request (from receipt to response).
 - Show how persistent sessions affect query time (first vs later queries).
 """
+
 import argparse
 import asyncio
-import base64
-import json
 import logging
+import random
 import signal
 import socket
+import struct
 import time
-from typing import cast, override
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import BinaryIO, cast, override
 
+import dns.exception
 import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import orjson
 import requests
 from dns.rrset import RRset
+from requests.adapters import HTTPAdapter
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 type Address = tuple[str, int]
+type CacheKey = tuple[dns.name.Name, int]
 
 HOST_ADDR = ("127.0.0.1", 1053)
 UPSTREAM_SERVER = "8.8.8.8"
 UPSTREAM_SERVER_DOH = "https://dns.google/dns-query"
 
-DNS_TYPES = {
-    1: "A",
-    2: "NS",
-    5: "CNAME",
-    6: "SOA",
-    12: "PTR",
-    15: "MX",
-    16: "TXT",
-    28: "AAAA",
-    33: "SRV",
-    35: "NAPTR",
-    38: "A6",
-    39: "DNAME",
-    41: "OPT",
-    43: "DS",
-    46: "RRSIG",
-    47: "NSEC",
-    48: "DNSKEY",
-    255: "ANY",
-}
+# Most replies kept in the cache; the least recently used go first
+CACHE_SIZE = 4096
+# Answer TTLs are clamped to this range for caching; NXDOMAIN is cached for
+# a fixed time
+CACHE_MIN_TTL = 60
+CACHE_MAX_TTL = 86400
+CACHE_NXDOMAIN_TTL = 60
+# Threads kept around to run the blocking requests calls
+DOH_WORKERS = 32
+# Delay before the first DoH retry; it doubles with each further attempt
+RETRY_BASE_DELAY = 0.25
+# Upper bound on queries being handled at once; the rest wait their turn
+QUERY_CONCURRENCY = 256
+
+# Every datagram is received into one preallocated buffer of this size, and at
+# most this many are read off the socket each time it becomes readable
+MAX_DATAGRAM_SIZE = 65535
+MAX_READS_PER_WAKEUP = 64
+
+# Under --debug, parsed replies are appended to this file as one JSON object
+# per line, each flushed as a single write once complete
+OUTPUT_FILE = "output.ndjson"
+OUTPUT_BUFFER_SIZE = 1 << 16
+
+# A header's QDCOUNT/ANCOUNT, and the TTL and RDLENGTH of a resource record
+# (skipping TYPE and CLASS)
+UNPACK_2H = struct.Struct("!2H").unpack_from
+UNPACK_RR = struct.Struct("!4xIH").unpack_from
+# All four section counts of a header, and the TYPE, TTL and RDLENGTH of a
+# resource record along with a packer for rewriting just its TTL
+UNPACK_4H = struct.Struct("!4H").unpack_from
+UNPACK_RR_TYPE = struct.Struct("!H2xIH").unpack_from
+PACK_TTL = struct.Struct("!I").pack_into
+# Pseudo-record type whose TTL field holds EDNS flags rather than a TTL
+OPT_TYPE = 41
 
 logger = logging.getLogger(__name__)
 
 
-class BasicDNSProxy(asyncio.DatagramProtocol):
-    transport: asyncio.DatagramTransport | None
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    Receiving end of the upstream socket shared by all queries. Resolves the
+    pending future registered under the reply's transaction ID.
+    """
+
+    pending: dict[bytes, asyncio.Future[bytes]]
+
+    def __init__(self, pending: dict[bytes, asyncio.Future[bytes]]):
+        self.pending = pending
+
+    @override
+    def datagram_received(self, data: bytes, addr: Address) -> None:
+        on_response = self.pending.get(data[:2])
+        if on_response and not on_response.done():
+            on_response.set_result(data)
+
+
+class BasicDNSProxy:
+    sock: socket.socket | None
+    recv_buf: bytearray
+    recv_view: memoryview
+    upstream: asyncio.DatagramTransport | None
+    pending: dict[bytes, asyncio.Future[bytes]]
     session: requests.Session | None
+    executor: ThreadPoolExecutor | None
+    cache: OrderedDict[CacheKey, tuple[float, float, bytes]]
+    inflight: dict[CacheKey, asyncio.Future[bytes | None]]
+    log_queue: asyncio.Queue[bytes]
+    log_task: asyncio.Task[None] | None
+    log_file: BinaryIO | None
+    query_slots: asyncio.Semaphore
 
     upstream_server: Address
     debug: bool
     doh: bool
-
-    def __init__(self, debug_flag: bool, upstream_server: str, doh_flag: bool):
-        self.transport = None
+    caching: bool
+    inject_latency: float
+
+    def __init__(
+        self,
+        debug_flag: bool,
+        upstream_server: str,
+        doh_flag: bool,
+        cache_flag: bool = False,
+        inject_latency: float = 0.0,
+    ):
+        self.sock = None
+        self.recv_buf = bytearray(MAX_DATAGRAM_SIZE)
+        self.recv_view = memoryview(self.recv_buf)
+        self.upstream = None
+        self.pending = {}
 
         self.upstream_server = (upstream_server, 80 if doh_flag else 53)
         self.debug = debug_flag
         self.doh = doh_flag
+        self.caching = cache_flag
+        self.inject_latency = inject_latency
+
+        # Wire-format replies by question, with the times they were stored and
+        # expire at. Only used with --cache, so that by default every query's
+        # timing reflects a trip to the upstream
+        self.cache = OrderedDict()
+        # Questions being fetched right now, resolved with the reply (or None
+        # if every attempt failed) for any duplicates that arrive meanwhile
+        self.inflight = {}
+        # Replies waiting to be parsed and dumped under --debug
+        self.log_queue = asyncio.Queue()
+        self.log_task = None
+        self.log_file = None
+        self.query_slots = asyncio.Semaphore(QUERY_CONCURRENCY)
+
+        # Built in connection_made, and only for DoH
+        self.session = None
+        self.executor = None
+
+    def connection_made(self, sock: socket.socket) -> None:
+        """
+        Starts serving on a bound, non-blocking UDP socket, creating the DoH
+        session and its threads first. The socket is watched with
+        loop.add_reader rather than wrapped in a datagram transport, so that
+        one wakeup reads up to MAX_READS_PER_WAKEUP datagrams.
+        """
+        self.sock = sock
 
+        # Created before any datagram can arrive, so handlers can rely on them
         if self.doh:
-            self.session = requests.Session()
-            self.session.headers.update({"accept": "application/dns-message"})
+            session = self.session = requests.Session()
+            session.headers.update(
+                {
+                    "accept": "application/dns-message",
+                    "accept-encoding": "identity",
+                    "content-type": "application/dns-message",
+                }
+            )
+            # The default pool keeps only 10 connections, fewer than there
+            # are worker threads; retries are left to handle_doh_query's backoff
+            adapter = HTTPAdapter(pool_maxsize=DOH_WORKERS, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            # requests is blocking, so DoH calls run on a dedicated pool
+            # instead of the loop's default executor shared via to_thread
+            self.executor = ThreadPoolExecutor(
+                max_workers=DOH_WORKERS, thread_name_prefix="doh"
+            )
 
-    @override
-    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
-        self.transport = transport
+        if self.debug:
+            self.log_task = asyncio.create_task(self.drain_log())
+            self.log_file = open(OUTPUT_FILE, "ab", buffering=OUTPUT_BUFFER_SIZE)
+
+        asyncio.get_running_loop().add_reader(sock.fileno(), self.read_ready)
         print(f"Listening on {HOST_ADDR[0]}:{HOST_ADDR[1]}")
 
-    @override
+    def connection_lost(self) -> None:
+        """
+        Stops serving and releases the listening socket, the upstream
+        transport, and the DoH session and its threads.
+        """
+        if self.sock:
+            _ = asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+        if self.upstream:
+            self.upstream.close()
+        if self.session:
+            self.session.close()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def close_log(self) -> None:
+        """
+        Stops drain_log, waiting out any reply it is still writing, and only
+        then closes the reply log.
+        """
+        if self.log_task:
+            _ = self.log_task.cancel()
+            _ = await asyncio.gather(self.log_task, return_exceptions=True)
+        if self.log_file:
+            self.log_file.close()
+
+    def read_ready(self) -> None:
+        sock = cast(socket.socket, self.sock)
+        for _ in range(MAX_READS_PER_WAKEUP):
+            try:
+                nbytes, addr = sock.recvfrom_into(self.recv_buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                print(f"Receive failed: {e}")
+                return
+
+            self.datagram_received(self.recv_view[:nbytes].tobytes(), addr)
+
+    def send_reply(self, reply: bytes, addr: Address) -> None:
+        try:
+            _ = cast(socket.socket, self.sock).sendto(reply, addr)
+        except (BlockingIOError, InterruptedError):
+            print(f"Send buffer full, dropped reply to {addr}")
+
     def datagram_received(self, data: bytes, addr: Address) -> None:
         if self.doh:
-            _ = asyncio.create_task(self.handle_doh_query(data, addr))
+            start = time.perf_counter_ns()
+            # Parsed once here and passed down to the handler
+            try:
+                msg = dns.message.from_wire(data)
+            except dns.exception.DNSException:
+                print(f"Malformed query from {addr}")
+                return
+
+            key: CacheKey | None = None
+            if len(msg.question) == 1:
+                key = (msg.question[0].name, msg.question[0].rdtype)
+                reply = self.cache_lookup(key) if self.caching else None
+                if reply:
+                    log_query(msg)
+                    self.send_reply(reply_for(data, reply), addr)
+                    log_elapsed(msg.id, start, "cache hit")
+                    return
+
+            _ = asyncio.create_task(self.dispatch_query(data, msg, addr, key))
         else:
-            _ = asyncio.create_task(self.handle_query(data, addr))
+            _ = asyncio.create_task(self.dispatch_query(data, None, addr, None))
+
+    async def dispatch_query(
+        self,
+        data: bytes,
+        msg: dns.message.Message | None,
+        addr: Address,
+        key: CacheKey | None,
+    ) -> None:
+        """
+        Hands a query to its upstream handler once one of the
+        QUERY_CONCURRENCY slots is free, so a burst of datagrams cannot put
+        an unbounded number of queries in flight. If the same question is
+        already being fetched, it waits for that reply and relays it under
+        its own transaction ID and question instead.
+        """
+        await self.stall()
+        if not key:
+            async with self.query_slots:
+                if self.doh:
+                    init_msg = cast(dns.message.Message, msg)
+                    _ = await self.handle_doh_query(data, init_msg, addr, key)
+                else:
+                    await self.handle_query(data, addr)
+            return
+
+        inflight = self.inflight.get(key)
+        if inflight:
+            follower_msg = cast(dns.message.Message, msg)
+            log_query(follower_msg)
+            start = time.perf_counter_ns()
+            # Shielded so that cancelling this task leaves the fetch alone
+            reply = await asyncio.shield(inflight)
+            if reply:
+                self.send_reply(reply_for(data, reply), addr)
+                log_elapsed(follower_msg.id, start, "shared in-flight reply")
+            return
+
+        inflight = self.inflight[key] = asyncio.get_running_loop().create_future()
+        reply: bytes | None = None
+        try:
+            async with self.query_slots:
+                init_msg = cast(dns.message.Message, msg)
+                reply = await self.handle_doh_query(data, init_msg, addr, key)
+        finally:
+            del self.inflight[key]
+            inflight.set_result(reply)
+
+    async def stall(self) -> None:
+        """
+        Holds a query back for --inject-latency seconds before it is
+        dispatched, ahead of its timer and of taking a QUERY_CONCURRENCY slot,
+        so that the stall neither skews the logged times nor starves others.
+        """
+        if self.inject_latency > 0:
+            logger.debug("Task sleeping for %ss...", self.inject_latency)
+            await asyncio.sleep(self.inject_latency)
 
-    async def handle_doh_query(self, data: bytes, addr: Address) -> None:
+    def cache_lookup(self, key: CacheKey) -> bytes | None:
         """
-        Coroutine for DoH (RFC 8484) queries.
+        Returns the cached reply to a question, unless it is missing or has
+        outlived its TTL. Its TTLs are counted down by the time it has spent
+        in the cache, and never exceed the time it has left there, since
+        cache_store may have clamped that to more or less than the upstream
+        sent.
+        """
+        entry = self.cache.get(key)
+        if not entry:
+            return None
+
+        stored, expiry, reply = entry
+        now = time.monotonic()
+        if expiry <= now:
+            del self.cache[key]
+            return None
+
+        try:
+            reply = age_reply(reply, int(now - stored), int(expiry - now))
+        except ValueError:
+            del self.cache[key]
+            return None
+
+        self.cache.move_to_end(key)
+        return reply
+
+    def cache_store(self, key: CacheKey | None, reply: bytes) -> None:
+        """
+        Caches a reply for the shortest TTL among its answers, clamped to
+        [CACHE_MIN_TTL, CACHE_MAX_TTL], or for CACHE_NXDOMAIN_TTL if the name
+        does not exist. Evicts the least recently used entry once CACHE_SIZE
+        is exceeded.
+        """
+        if not key or not self.caching:
+            return
+        try:
+            ttl = min_answer_ttl(reply)
+        except ValueError:
+            return
+
+        # RCODE is the low nibble of the header's fourth byte
+        if reply[3] & 0x0F == dns.rcode.NXDOMAIN:
+            ttl = CACHE_NXDOMAIN_TTL
+        elif ttl <= 0:
+            return
+        else:
+            ttl = min(max(ttl, CACHE_MIN_TTL), CACHE_MAX_TTL)
+
+        now = time.monotonic()
+        self.cache[key] = (now, now + ttl, reply)
+        self.cache.move_to_end(key)
+        if len(self.cache) > CACHE_SIZE:
+            _ = self.cache.popitem(last=False)
+
+    async def handle_doh_query(
+        self,
+        data: bytes,
+        init_msg: dns.message.Message,
+        addr: Address,
+        key: CacheKey | None,
+    ) -> bytes | None:
+        """
+        Coroutine for DoH (RFC 8484) queries, sent as POST requests whose body
+        is the query in wire format. Returns the reply relayed to the client,
+        or None if no attempt got one.
         """
-        init_msg = dns.message.from_wire(data)
         id = init_msg.id
-        question = parse_dns_section(init_msg.question)[0]
-        logger.info(f"(ID{id}) QUERY [ Name: {question[0]}, Type: {question[1]} ]")
-
-        start = time.time_ns()
-        logger.info(f"(ID{id}) START Timer")
+        log_query(init_msg)
+        start = time.perf_counter_ns()
 
-        if self.debug:
-            print("Task sleeping...")
-            await asyncio.sleep(3)
-
-        init_msg.id = 0
-        encoded_msg = base64.urlsafe_b64encode(init_msg.to_wire()).rstrip(b"=")
+        # RFC 8484 asks for an ID of 0 so that replies stay cacheable; the
+        # received bytes are forwarded with just that field cleared rather
+        # than re-serialized from the parsed message
+        wire = b"\x00\x00" + data[2:]
 
         for attempt in range(3):
             try:
                 session_ = cast(requests.Session, self.session)
 
-                response = await asyncio.to_thread(
-                    session_.get,
-                    self.upstream_server[0],
-                    params={"dns": encoded_msg},
+                response = await asyncio.get_running_loop().run_in_executor(
+                    self.executor,
+                    partial(
+                        session_.post, self.upstream_server[0], data=wire, timeout=3
+                    ),
                 )
 
-                parsed = self.DNSQueryParser(response.content)
-                print(parsed)
-
-                init_msg.id = id
-                reply_msg = parsed.build_dns_reply(init_msg)
+                # The upstream's reply is already complete; only the ID that
+                # was zeroed for forwarding needs restoring
+                reply = data[:2] + dns_message_body(response)[2:]
+                self.send_reply(reply, addr)
+                self.cache_store(key, reply)
 
-                transport_ = cast(asyncio.DatagramTransport, self.transport)
-                transport_.sendto(reply_msg.to_wire(), addr)
+                if self.debug:
+                    self.log_queue.put_nowait(reply)
 
-                end = time.time_ns()
-                logger.info(f"(ID{id}) END Time elapsed: {(end - start) / 1_000_000}ms")
-                break
-            except asyncio.TimeoutError or requests.exceptions.Timeout:
+                log_elapsed(id, start)
+                return reply
+            except (asyncio.TimeoutError, requests.exceptions.Timeout):
                 print(f"Upstream timeout for {addr}, attempt {attempt + 1}")
                 print(f"Retries remaining: {2 - attempt}")
             except requests.exceptions.ConnectionError:
                 print(f"Upstream refused connection for {addr}, attempt {attempt + 1}")
                 print(f"Retries remaining: {2 - attempt}")
-                if attempt < 2:
-                    await asyncio.sleep(1)
+            except requests.exceptions.HTTPError as e:
+                print(f"Upstream error for {addr}, attempt {attempt + 1}: {e}")
+                print(f"Retries remaining: {2 - attempt}")
+
+            if attempt < 2:
+                # Exponential backoff, jittered so that queries failing
+                # together do not all retry at the same moment
+                delay = RETRY_BASE_DELAY * 2**attempt
+                await asyncio.sleep(delay + random.uniform(0, delay))
+
+        return None
 
     async def handle_query(self, data: bytes, addr: Address) -> None:
         """
         Coroutine for non-DoH queries.
         """
-        if self.debug:
-            print("Task sleeping...")
-            await asyncio.sleep(3)
-
-        transport: asyncio.DatagramTransport | None = None
-
         loop = asyncio.get_running_loop()
+        upstream = cast(asyncio.DatagramTransport, self.upstream)
+
+        # Upstream replies are routed by transaction ID, so a query whose ID is
+        # already in flight goes out under a free one and is restored on reply
+        txid = data[:2]
+        while txid in self.pending:
+            txid = random.randbytes(2)
+        query = data if txid == data[:2] else txid + data[2:]
 
         for attempt in range(3):
             try:
                 on_response: asyncio.Future[bytes] = loop.create_future()
+                self.pending[txid] = on_response
 
-                def on_response_factory():
-                    class Upstream(asyncio.DatagramProtocol):
-                        @override
-                        def datagram_received(self, data: bytes, addr: Address) -> None:
-                            if not on_response.done():
-                                on_response.set_result(data)
-
-                    return Upstream()
-
-                transport, _ = await loop.create_datagram_endpoint(
-                    on_response_factory,
-                    remote_addr=self.upstream_server,
-                    family=socket.AF_INET,
-                )
-
-                transport.sendto(data)
+                upstream.sendto(query)
 
                 response: bytes = await asyncio.wait_for(on_response, timeout=3)
+                if query is not data:
+                    response = data[:2] + response[2:]
 
-                parsed = self.DNSQueryParser(response)
-                print(parsed)
+                self.send_reply(response, addr)
 
-                transport_ = cast(asyncio.DatagramTransport, self.transport)
-                transport_.sendto(response, addr)
+                if self.debug:
+                    self.log_queue.put_nowait(response)
                 break
             except asyncio.TimeoutError:
                 print(f"Upstream timeout for {addr}, attempt {attempt + 1}")
                 print(f"Retries remaining: {2 - attempt}")
             finally:
-                if transport:
-                    transport.close()
+                _ = self.pending.pop(txid, None)
+
+    async def drain_log(self) -> None:
+        """
+        Single consumer for replies queued under --debug. Parsing and the
+        OUTPUT_FILE dump run on a worker thread, off the event loop; draining
+        in order keeps the file writes from interleaving.
+        """
+        while True:
+            reply = await self.log_queue.get()
+            write = asyncio.create_task(asyncio.to_thread(self.log_reply, reply))
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # The worker thread cannot be interrupted, so it is left to
+                # finish with OUTPUT_FILE before the cancellation goes through
+                _ = await asyncio.wait([write])
+                raise
+            except Exception as e:
+                print(f"Failed to parse reply: {e}")
+
+    def log_reply(self, reply: bytes) -> None:
+        parsed = self.DNSQueryParser(reply)
+        logger.debug("%s", parsed)
+        log_file = cast(BinaryIO, self.log_file)
+        parsed.write_to_file(log_file)
+        log_file.flush()
 
     class DNSQueryParser:
         query: dns.message.Message
+        records: dict[str, list[tuple[str, str, int | None]]]
 
         def __init__(self, query: bytes) -> None:
             self.query = dns.message.from_wire(query)
 
-            self.write_to_file()
+            # Each section is walked once; __str__ and write_to_file share it
+            self.records = {
+                "question": parse_dns_section(self.query.question),
+                "answer": parse_dns_section(self.query.answer),
+                "authority": parse_dns_section(self.query.authority),
+                "additional": parse_dns_section(
+                    self.query.additional + [self.query.opt]
+                    if self.query.opt
+                    else self.query.additional
+                ),
+            }
 
         @override
         def __str__(self) -> str:
             sections = [
-                ("Questions", self.query.question),
-                ("Answer RRs", self.query.answer),
-                ("Authority RRs", self.query.authority),
-                ("Additional RRs", self.query.additional),
+                ("Questions", self.records["question"]),
+                ("Answer RRs", self.records["answer"]),
+                ("Authority RRs", self.records["authority"]),
+                ("Additional RRs", self.records["additional"]),
             ]
 
             lines = ["\n=START==============="]
 
-            for section, rrsets in sections:
-                section_count = self.query.section_count(rrsets)
-                lines.append(f"{section} ({section_count}):")
+            for section, records in sections:
+                lines.append(f"{section} ({len(records)}):")
 
-                if not section_count:
+                if not records:
                     lines.append("  (none)")
-                else:
-                    records = parse_dns_section(rrsets)
-                    if not records and self.query.opt:
-                        records = parse_dns_section([self.query.opt])
 
-                    for name, type, rlength in records:
-                        line = f"  - Name: {name}, Type: {type}"
-                        if rlength:
-                            line += f" ({rlength} bytes)"
-                        lines.append(line)
+                for name, type, rlength in records:
+                    line = f"  - Name: {name}, Type: {type}"
+                    if rlength:
+                        line += f" ({rlength} bytes)"
+                    lines.append(line)
 
             lines.append("==============END=\n")
             return "\n".join(lines)
 
-        def build_dns_reply(self, init_msg: dns.message.Message) -> dns.message.Message:
-            reply_msg = dns.message.make_response(
-                init_msg,
-                recursion_available=True,
-            )
-            reply_msg.answer.extend(self.query.answer)
-            reply_msg.authority.extend(self.query.authority)
-            reply_msg.additional.extend(self.query.additional)
-            reply_msg.use_edns(
-                edns=self.query.edns,
-                ednsflags=self.query.ednsflags,
-                payload=self.query.payload,
-            )
+        def write_to_file(self, output: BinaryIO) -> None:
+            data = {
+                "question": [
+                    {"name": name, "type": type}
+                    for name, type, _ in self.records["question"]
+                ],
+                "answer": [
+                    {"name": name, "type": type, "resource_size": size}
+                    for name, type, size in self.records["answer"]
+                ],
+                "authority": [
+                    {"name": name, "type": type, "resource_size": size}
+                    for name, type, size in self.records["authority"]
+                ],
+                "additional": [
+                    {"name": name, "type": type, "resource_size": size}
+                    for name, type, size in self.records["additional"]
+                ],
+            }
+
+            _ = output.write(orjson.dumps(data, option=orjson.OPT_APPEND_NEWLINE))
+
+
+def log_query(msg: dns.message.Message) -> None:
+    """
+    Logs a query's (first) question and the start of its timer.
+    """
+    # Only worth parsing the question for if the record will be emitted
+    if logger.isEnabledFor(logging.INFO) and msg.question:
+        question = parse_dns_section(msg.question[:1])[0]
+        logger.info(
+            "(ID%s) QUERY [ Name: %s, Type: %s ]", msg.id, question[0], question[1]
+        )
+    logger.info("(ID%s) START Timer", msg.id)
 
-            return reply_msg
-
-        def write_to_file(self) -> None:
-            with open("output.json", "w") as output:
-                data = {
-                    "question": [
-                        {"name": name, "type": type}
-                        for name, type, _ in parse_dns_section(self.query.question)
-                    ],
-                    "answer": [
-                        {"name": name, "type": type, "resource_size": size}
-                        for name, type, size in parse_dns_section(self.query.answer)
-                    ],
-                    "authority": [
-                        {"name": name, "type": type, "resource_size": size}
-                        for name, type, size in parse_dns_section(self.query.authority)
-                    ],
-                    "additional": [
-                        {"name": name, "type": type, "resource_size": size}
-                        for name, type, size in parse_dns_section(
-                            self.query.additional + [self.query.opt]
-                            if self.query.opt
-                            else self.query.additional
-                        )
-                    ],
-                }
 
-                json.dump(data, output, indent=4)
+def log_elapsed(id: int, start: int, answered_by: str | None = None) -> None:
+    """
+    Logs the time since start, a perf_counter_ns() reading, for the query
+    with the given ID, noting how it was answered if not by the upstream.
+    """
+    elapsed = (time.perf_counter_ns() - start) / 1_000_000
+    if answered_by:
+        logger.info("(ID%s) END Time elapsed: %sms (%s)", id, elapsed, answered_by)
+    else:
+        logger.info("(ID%s) END Time elapsed: %sms", id, elapsed)
+
+
+@lru_cache(maxsize=256)
+def rdtype_to_text(rdtype: dns.rdatatype.RdataType) -> str:
+    """
+    Returns the mnemonic for a record type code, e.g. "A" or "HTTPS". Types
+    dnspython does not know come back as "TYPE<n>". Memoized, since only a
+    handful of distinct types show up in practice.
+    """
+    return dns.rdatatype.to_text(rdtype)
 
 
 def parse_dns_section(rrsets: list[RRset]) -> list[tuple[str, str, int | None]]:
@@ -272,31 +610,151 @@ def parse_dns_section(rrsets: list[RRset]) -> list[tuple[str, str, int | None]]:
     Extracts name, type, and size of payload (if any) of every record in a
     section of a dns.message.Message object. Returns a list of tuples.
     """
+    # processing_order() builds a fresh shuffled list, so it is only called
+    # once per RRset; hot lookups are bound to locals up front
     records: list[tuple[str, str, int | None]] = []
+    add_record = records.append
+    type_name = rdtype_to_text
     for rrset in rrsets:
         name = rrset.name.to_unicode()
-        type = DNS_TYPES[rrset.rdtype]
+        type = type_name(rrset.rdtype)
 
-        if not rrset.processing_order():
-            records.append((name, type, None))
+        order = rrset.processing_order()
+        if not order:
+            add_record((name, type, None))
         else:
-            for rdata in rrset.processing_order():
+            for rdata in order:
                 bytes = rdata.to_wire()
                 rlength = len(bytes) if bytes else 0
-                records.append((name, type, rlength))
+                add_record((name, type, rlength))
 
     return records
 
 
-async def main():
-    logging.basicConfig(filename="part3.log", filemode="w", level=logging.INFO)
+def dns_message_body(response: requests.Response) -> bytes:
+    """
+    Returns the DNS reply carried in the body of a DoH response. Raises
+    requests.exceptions.HTTPError if the upstream answered with an error
+    status, or with anything other than a DNS message.
+    """
+    response.raise_for_status()
+    content_type = response.headers.get("content-type")
+    if content_type != "application/dns-message":
+        raise requests.exceptions.HTTPError(
+            f"Unexpected content type {content_type!r}", response=response
+        )
+    return response.content
+
+
+def skip_name(data: bytes, posn: int) -> int:
+    """
+    Returns the offset just past the (possibly compressed) name at posn.
+    """
+    label_len = data[posn]
+    while label_len:
+        if label_len & 0xC0:
+            return posn + 2
+        posn += label_len + 1
+        label_len = data[posn]
+    return posn + 1
+
+
+def reply_for(query: bytes, reply: bytes) -> bytes:
+    """
+    Readdresses a reply fetched for the same question to another query, with
+    the query's own transaction ID, RD and CD flags and question section.
+    Questions match case-insensitively, so the one asked may be capitalized
+    differently. Falls back to patching only the header if the two questions
+    are not laid out alike.
+    """
+    # RD is the low bit of the header's third byte and CD the 0x10 bit of its
+    # fourth; both are set by the client and echoed back in the reply
+    flags = bytes(
+        (reply[2] & ~0x01 | query[2] & 0x01, reply[3] & ~0x10 | query[3] & 0x10)
+    )
+    header = query[:2] + flags + reply[4:12]
+    try:
+        qend = skip_name(query, 12) + 4
+        if query[4:6] == reply[4:6] == b"\x00\x01" and skip_name(reply, 12) + 4 == qend:
+            return header + query[12:qend] + reply[qend:]
+    except IndexError:
+        pass
+
+    return header + reply[12:]
+
+
+def min_answer_ttl(data: bytes) -> int:
+    """
+    Returns the shortest TTL among a reply's answer records, read straight off
+    the wire, or 0 if it has none. Raises ValueError if the reply is truncated.
+    """
+    try:
+        counts: tuple[int, int] = UNPACK_2H(data, 4)
+        qdcount, ancount = counts
+
+        posn = 12
+        for _ in range(qdcount):
+            posn = skip_name(data, posn) + 4
+
+        ttl: int | None = None
+        for _ in range(ancount):
+            posn = skip_name(data, posn)
+            fields: tuple[int, int] = UNPACK_RR(data, posn)
+            record_ttl, rdlength = fields
+            if ttl is None or record_ttl < ttl:
+                ttl = record_ttl
+            posn += 10 + rdlength
+    except (IndexError, struct.error) as e:
+        raise ValueError("Truncated reply") from e
 
+    return ttl or 0
+
+
+def age_reply(data: bytes, elapsed: int, remaining: int) -> bytes:
+    """
+    Returns a copy of a reply with the TTL of every record lowered by elapsed
+    seconds, but not below 0, and capped at remaining. The OPT pseudo-record
+    is left as it is. Raises ValueError if the reply is truncated.
+    """
+    aged = bytearray(data)
+    try:
+        counts: tuple[int, int, int, int] = UNPACK_4H(data, 4)
+        qdcount, ancount, nscount, arcount = counts
+
+        posn = 12
+        for _ in range(qdcount):
+            posn = skip_name(data, posn) + 4
+
+        for _ in range(ancount + nscount + arcount):
+            posn = skip_name(data, posn)
+            fields: tuple[int, int, int] = UNPACK_RR_TYPE(data, posn)
+            rdtype, ttl, rdlength = fields
+            if rdtype != OPT_TYPE:
+                PACK_TTL(aged, posn + 4, min(max(ttl - elapsed, 0), remaining))
+            posn += 10 + rdlength
+    except (IndexError, struct.error) as e:
+        raise ValueError("Truncated reply") from e
+
+    return bytes(aged)
+
+
+async def main():
     parser = argparse.ArgumentParser()
     _ = parser.add_argument("--upstream", type=str, default=UPSTREAM_SERVER)
     _ = parser.add_argument("--debug", action="store_true")
     _ = parser.add_argument("--doh", action="store_true")
+    _ = parser.add_argument("--cache", action="store_true")
+    _ = parser.add_argument(
+        "--inject-latency", type=float, default=0.0, metavar="SECONDS"
+    )
     args = parser.parse_args()
 
+    logging.basicConfig(
+        filename="part3.log",
+        filemode="w",
+        level=logging.DEBUG if args.debug else logging.INFO,
+    )
+
     loop = asyncio.get_running_loop()
     stop_event = asyncio.Event()
 
@@ -308,18 +766,28 @@ async def main():
         else args.upstream
     )
 
-    proxy = BasicDNSProxy(args.debug, upstream, args.doh)
-    transport, _ = await loop.create_datagram_endpoint(
-        lambda: proxy,
-        local_addr=HOST_ADDR,
+    proxy = BasicDNSProxy(
+        args.debug, upstream, args.doh, args.cache, args.inject_latency
     )
 
+    if not args.doh:
+        upstream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        upstream_sock.setblocking(False)
+        upstream_sock.connect(proxy.upstream_server)
+        proxy.upstream, _ = await loop.create_datagram_endpoint(
+            lambda: UpstreamProtocol(proxy.pending), sock=upstream_sock
+        )
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind(HOST_ADDR)
+    proxy.connection_made(sock)
+
     try:
         _ = await stop_event.wait()
     finally:
-        if proxy.session:
-            proxy.session.close()
-        transport.close()
+        proxy.connection_lost()
+        await proxy.close_log()
 
     pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
     for task in pending:
@@ -329,4 +797,7 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())